@@ -1,13 +1,131 @@
+import asyncio
+import glob
 import os
-from datetime import datetime
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+from uuid import uuid4
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from dateutil.relativedelta import relativedelta
 import dukascopy_python
-import pytz
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import requests
+from requests.adapters import HTTPAdapter
+
+# Number of append-only shards a month may accumulate before they are compacted into one file.
+MAX_SHARDS_PER_MONTH = 8
+
+# Number of cache months written at the same time.
+MAX_CONCURRENT_WRITES = 4
+
+# Rows per parquet row group in the cache. Each row group carries its own min/max timestamp statistics, so
+# reads of a partial month only decode the row groups that overlap the requested range.
+CACHE_ROW_GROUP_SIZE = 100_000
+
+# Number of symbols that are downloaded and processed at the same time.
+MAX_CONCURRENT_SYMBOLS = 4
+
+# Number of month chunks of a single symbol that are downloaded at the same time.
+MAX_CONCURRENT_CHUNKS = 6
+
+# How far before the last cached tick an update starts fetching again.
+FETCH_OVERLAP = pd.Timedelta(minutes=5)
+
+# Kept-alive HTTPS connections to Dukascopy, enough for every month chunk of every concurrent symbol.
+HTTP_POOL_SIZE = MAX_CONCURRENT_SYMBOLS * MAX_CONCURRENT_CHUNKS
+
+# Requests started against the free Dukascopy endpoint per period, shared by all symbols and month chunks. Up to
+# HTTP_POOL_SIZE streams run at once, this keeps them from hammering the server.
+MAX_REQUESTS_PER_PERIOD = 5
+REQUEST_PERIOD_SECONDS = 2.0
+
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+# Zone names that all mean UTC, Dukascopy ticks are always in UTC.
+UTC_ZONE_NAMES = frozenset({'UTC', 'Etc/UTC', 'Etc/UCT', 'Etc/Universal', 'Etc/Zulu', 'UCT', 'Universal', 'Zulu'})
+
+# Rows converted to Arrow and written per slice of the broker CSV, which bounds the extra memory the export needs.
+OUTPUT_CSV_BATCH_ROWS = 500_000
+
+# float32 only has a 24-bit mantissa, which rounds prices of index and crypto CFDs (e.g. 44123.457 on USA30.IDX/USD or
+# 140523.46 on BTC/USD), so prices stay float64 and only the volumes are downcast.
+TICK_DTYPES = {
+    'bidPrice': 'float64',
+    'askPrice': 'float64',
+    'bidVolume': 'float32',
+    'askVolume': 'float32',
+}
+
+# Schema of the CSV files written by the old YYYY/MM.csv cache layout.
+LEGACY_CSV_COLUMN_TYPES = {
+    'timestamp': pa.timestamp('us', tz='UTC'),
+    'bidPrice': pa.float64(),
+    'askPrice': pa.float64(),
+    'bidVolume': pa.float32(),
+    'askVolume': pa.float32(),
+}
+
+class _RateLimiter:
+    """Lets at most max_rate calls start within any time_period seconds, across threads."""
+
+    def __init__(self, max_rate: int, time_period: float):
+        self._max_rate = max_rate
+        self._time_period = time_period
+        self._starts = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._starts and now - self._starts[0] >= self._time_period:
+                    self._starts.popleft()
+                if len(self._starts) < self._max_rate:
+                    self._starts.append(now)
+                    return
+                time.sleep(self._time_period - (now - self._starts[0]))
+
+
+class _PooledRequests:
+    """Stands in for the requests module inside dukascopy_python, sending its GETs through one pooled session."""
+
+    def __init__(self, session: requests.Session, limiter: _RateLimiter):
+        self._session = session
+        self._limiter = limiter
+
+    def get(self, *args, **kwargs):
+        self._limiter.acquire()
+        return self._session.get(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+@lru_cache(maxsize=None)
+def _install_shared_http_session() -> requests.Session:
+    # dukascopy_python calls requests.get for every page of ticks, which opens a new connection and TLS handshake each
+    # time. It takes no session argument, so route its module level requests reference through a keep-alive pool, which
+    # also rate limits the requests of every symbol and month chunk together.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    dukascopy_python.requests = _PooledRequests(session, _RateLimiter(MAX_REQUESTS_PER_PERIOD, REQUEST_PERIOD_SECONDS))
+    return session
+
 
 class Dukascopy_Tick_Data_Fetcher:
     def __init__(self):
         self.broker_timezone = "Europe/Helsinki"
+        _install_shared_http_session()
 
     def get(
             self,
@@ -16,145 +134,481 @@ class Dukascopy_Tick_Data_Fetcher:
             tick_data_repo_dir: str,
             broker_ticks_output_dir: str,
             broker_timezone: str = None,
-            date_suffix_on_output_csv_file: bool = False
+            date_suffix_on_output_csv_file: bool = False,
+            output_format: str = 'csv',
+            min_staleness: timedelta = timedelta(hours=1)
         ):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}. Expected one of {OUTPUT_FORMATS}")
+
         os.makedirs(tick_data_repo_dir, exist_ok=True)
         os.makedirs(broker_ticks_output_dir, exist_ok=True)
 
         target_tz_str = broker_timezone if broker_timezone is not None else self.broker_timezone
-        target_tz = pytz.timezone(target_tz_str)
+        target_tz = ZoneInfo(target_tz_str)
         print(f"Using broker timezone: {target_tz_str}")
 
-        utc_tz = pytz.timezone("UTC")
-
-        end_date = pd.Timestamp.now(tz=utc_tz)
+        end_date = pd.Timestamp.now(tz="UTC")
         start_date = end_date - relativedelta(months=months_to_fetch)
         
         print(f"Required data range: {start_date.strftime('%Y-%m-%d %H:%M')} to {end_date.strftime('%Y-%m-%d %H:%M')} UTC")
 
-        for dukascopy_symbol, target_symbol in symbols:
-            print("-" * 50)
-            print(f"Processing symbol: {dukascopy_symbol} (Target: {target_symbol})")
-            
-            symbol_path = os.path.join(tick_data_repo_dir, dukascopy_symbol.replace('/', '_'))
-            os.makedirs(symbol_path, exist_ok=True)
+        # Everything the output file name depends on is the same for every symbol of this run.
+        tz_suffix = target_tz_str.replace('/', '_')
+        if date_suffix_on_output_csv_file:
+            today_str = datetime.now().strftime('%Y-%m-%d')
+            output_name_suffix = f"{tz_suffix}-{today_str}"
+        else:
+            output_name_suffix = tz_suffix
 
-            local_df = self._load_local_data(symbol_path, start_date, end_date)
+        job = dict(
+            tick_data_repo_dir=tick_data_repo_dir,
+            broker_ticks_output_dir=broker_ticks_output_dir,
+            start_date=start_date,
+            end_date=end_date,
+            target_tz=target_tz,
+            output_name_suffix=output_name_suffix,
+            output_format=output_format,
+            min_staleness=min_staleness,
+        )
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self._process_symbols(symbols, job))
+        else:
+            # Already inside an event loop (e.g. Jupyter), so drive ours from a worker thread.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(asyncio.run, self._process_symbols(symbols, job)).result()
+
+    async def _process_symbols(self, symbols: list[tuple[str, str]], job: dict):
+        sem = asyncio.Semaphore(MAX_CONCURRENT_SYMBOLS)
+        results = await asyncio.gather(
+            *[self._process_symbol(pair, sem, job) for pair in symbols],
+            return_exceptions=True,
+        )
+
+        for (dukascopy_symbol, _), result in zip(symbols, results):
+            if isinstance(result, Exception):
+                print(f"  ERROR processing {dukascopy_symbol}: {result}")
+
+    async def _process_symbol(self, pair: tuple[str, str], sem: asyncio.Semaphore, job: dict):
+        async with sem:
+            await asyncio.to_thread(self._process_symbol_blocking, pair, **job)
+
+    def _process_symbol_blocking(
+            self,
+            pair: tuple[str, str],
+            tick_data_repo_dir: str,
+            broker_ticks_output_dir: str,
+            start_date: datetime,
+            end_date: datetime,
+            target_tz: ZoneInfo,
+            output_name_suffix: str,
+            output_format: str,
+            min_staleness: timedelta
+        ):
+        dukascopy_symbol, target_symbol = pair
+        print(f"Processing symbol: {dukascopy_symbol} (Target: {target_symbol})")
+
+        symbol_path = os.path.join(tick_data_repo_dir, dukascopy_symbol.replace('/', '_'))
+        os.makedirs(symbol_path, exist_ok=True)
+
+        output_filename = f"{target_symbol}-{output_name_suffix}.{output_format}"
+        output_path = os.path.join(broker_ticks_output_dir, output_filename)
+
+        self._migrate_legacy_csv_cache(symbol_path)
+
+        # Repeat runs (e.g. from cron) find a fresh cache and an export written after it, so there is nothing to do.
+        # The newest cached timestamp comes from the parquet footers, without loading any ticks.
+        last_cached_timestamp = self._last_cached_timestamp(symbol_path)
+        if (
+            last_cached_timestamp is not None
+            and end_date - last_cached_timestamp < min_staleness
+            and os.path.exists(output_path)
+            and os.path.getmtime(output_path) > last_cached_timestamp.timestamp()
+            and self._export_starts_at(output_path, output_format, symbol_path, start_date, end_date, min_staleness)
+        ):
+            print(f"  {dukascopy_symbol}: Cache and {output_path} are up-to-date. Nothing to do.")
+            return
+
+        fetch_start_date = start_date
+
+        if last_cached_timestamp is not None and last_cached_timestamp >= start_date:
+            print(f"  {dukascopy_symbol}: Found local data up to {last_cached_timestamp.strftime('%Y-%m-%d %H:%M')}")
             
-            fetch_start_date = start_date
-            dfs_to_combine = []
-
-            if not local_df.empty:
-                last_local_timestamp = local_df.index.max()
-                print(f"Found local data up to {last_local_timestamp.strftime('%Y-%m-%d %H:%M')}")
-                
-                # Overlap rule: re-fetch from the start of the last day to ensure data completeness.
-                fetch_start_date = last_local_timestamp.floor('D')
-                
-                # Discard the last partial day from local data to prevent duplicate entries after fetching.
-                clean_local_df = local_df[local_df.index < fetch_start_date]
-                if not clean_local_df.empty:
-                    dfs_to_combine.append(clean_local_df)
-            else:
-                print("No local data found for this range.")
-
-            if fetch_start_date < end_date:
-                print(f"Fetching new data from Dukascopy: {fetch_start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}")
-                try:
-                    new_df = self._fetch_from_dukascopy(dukascopy_symbol, fetch_start_date, end_date)
-                    if not new_df.empty:
-                        self._save_local_data(symbol_path, new_df)
-                        dfs_to_combine.append(new_df)
-                except Exception as e:
-                    print(f"  ERROR fetching data for {dukascopy_symbol}: {e}")
-                    continue
+            if end_date - last_cached_timestamp < min_staleness:
+                # The cache is fresh enough, use it as is.
+                fetch_start_date = end_date
             else:
-                print("Local data is up-to-date. No download needed.")
+                # Overlap rule: re-fetch a few minutes before the last cached tick in case the tail was incomplete.
+                # _save_local_data only rewrites the newest shard if the overlap differs from what it holds.
+                fetch_start_date = last_cached_timestamp - FETCH_OVERLAP
+        else:
+            print(f"  {dukascopy_symbol}: No local data found for this range.")
 
-            if not dfs_to_combine:
-                print(f"No data available for {dukascopy_symbol} in the total specified range.")
-                continue
+        if fetch_start_date < end_date:
+            print(f"  {dukascopy_symbol}: Fetching new data from Dukascopy: {fetch_start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}")
+            try:
+                new_df = self._fetch_from_dukascopy(dukascopy_symbol, fetch_start_date, end_date)
+                if not new_df.empty:
+                    self._save_local_data(symbol_path, new_df)
+            except Exception as e:
+                print(f"  ERROR fetching data for {dukascopy_symbol}: {e}")
+                return
+        else:
+            print(f"  {dukascopy_symbol}: Local data is up-to-date. No download needed.")
 
-            raw_df = pd.concat(dfs_to_combine)
-            raw_df = raw_df[~raw_df.index.duplicated(keep='first')]
-            raw_df.sort_index(inplace=True)
-            
-            raw_df = raw_df.loc[start_date:end_date]
+        # The fresh ticks are in the cache now, so one filtered scan of it yields the whole range already merged,
+        # de-duplicated and sorted, with nothing to concatenate in pandas.
+        raw_df = self._load_local_data(symbol_path, start_date, end_date)
 
-            if raw_df.empty:
-                print(f"Final dataset is empty for {dukascopy_symbol} after processing.")
-                continue
+        if raw_df.empty:
+            print(f"No data available for {dukascopy_symbol} in the total specified range.")
+            return
 
+        if self._is_same_timezone(raw_df.index.tz, target_tz):
+            # Converting to the zone the ticks are already in would only rebuild the index.
+            processed_df = raw_df
+        else:
             processed_df = raw_df.tz_convert(target_tz)
 
-            tz_suffix = target_tz_str.replace('/', '_')
+        if output_format == 'parquet':
+            processed_df.to_parquet(output_path, engine='pyarrow', compression='snappy')
+        else:
+            self._write_csv(processed_df, output_path)
+        print(f"Successfully saved processed data to: {output_path}")
+        print(f"  First timestamp: {processed_df.index[0]}")
+        print(f"  Last timestamp:  {processed_df.index[-1]}")
 
-            if date_suffix_on_output_csv_file:
-                today_str = datetime.now().strftime('%Y-%m-%d')
-                output_filename = f"{target_symbol}-{tz_suffix}-{today_str}.csv"
-            else:
-                output_filename = f"{target_symbol}-{tz_suffix}.csv"
+    def _is_same_timezone(self, index_tz, target_tz: ZoneInfo) -> bool:
+        index_tz_name = str(index_tz)
+        if index_tz_name == target_tz.key:
+            return True
+        return index_tz_name in UTC_ZONE_NAMES and target_tz.key in UTC_ZONE_NAMES
 
-            output_path = os.path.join(broker_ticks_output_dir, output_filename)
-            
-            processed_df.to_csv(output_path)
-            print(f"Successfully saved processed data to: {output_path}")
-            print(f"  First timestamp: {processed_df.index[0]}")
-            print(f"  Last timestamp:  {processed_df.index[-1]}")
+    def _write_csv(self, df: pd.DataFrame, output_path: str):
+        df = df.rename_axis('timestamp')
+        write_options = pa_csv.WriteOptions(include_header=False, batch_size=1 << 16, eol=os.linesep, quoting_style='none')
+
+        with open(output_path, 'wb', buffering=1 << 20) as f:
+            f.write((",".join([df.index.name, *df.columns]) + os.linesep).encode())
+
+            # Convert and write in slices so only one slice is held as Arrow data and formatted strings at a time.
+            writer = None
+            for start in range(0, len(df), OUTPUT_CSV_BATCH_ROWS):
+                batch = pa.RecordBatch.from_pandas(df.iloc[start:start + OUTPUT_CSV_BATCH_ROWS].reset_index(), preserve_index=False)
+
+                # Broker wall time with microseconds and the UTC offset, the layout the MQL5 parser reads. Unlike to_csv,
+                # whole seconds keep their .000000 and numbers use Arrow's shortest form (100, 1e-7), which it also reads.
+                timestamps = batch.column('timestamp')
+                timestamps = pc.strftime(timestamps.cast(pa.timestamp('us', tz=timestamps.type.tz)), format='%Y-%m-%d %H:%M:%S%Ez')
+                batch = batch.set_column(0, 'timestamp', timestamps)
+
+                if writer is None:
+                    writer = pa_csv.CSVWriter(f, batch.schema, write_options=write_options)
+                writer.write_batch(batch)
+
+            if writer is not None:
+                writer.close()
 
     def _load_local_data(self, symbol_path: str, start_date: datetime, end_date: datetime) -> pd.DataFrame:
-        dfs = []
+        start_ts = pd.Timestamp(start_date).tz_convert('UTC')
+        end_ts = pd.Timestamp(end_date).tz_convert('UTC')
 
-        month_start = start_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        date_range = pd.date_range(month_start, end_date, freq='MS')
-        
-        for dt in date_range:
-            file_path = os.path.join(symbol_path, str(dt.year), f"{dt.month:02d}.csv")
-            if os.path.exists(file_path):
-                try:
-                    df = pd.read_csv(file_path, index_col='timestamp', date_format='ISO8601')
-                    if not df.empty:
-                        dfs.append(df)
-                except Exception as e:
-                    print(f"  Warning: Could not load or parse {file_path}. Error: {e}")
-        
-        if not dfs:
+        file_paths = self._cached_files(symbol_path, start_ts, end_ts)
+        if not file_paths:
             return pd.DataFrame()
-        
-        combined_df = pd.concat(dfs).sort_index()
-        return combined_df.loc[start_date:end_date]
+
+        try:
+            # One Arrow scan over every in-range shard, with the date range pushed down to the row groups.
+            dataset = ds.dataset(file_paths, format='parquet')
+            table = dataset.to_table(filter=(ds.field('timestamp') >= start_ts) & (ds.field('timestamp') <= end_ts))
+            df = table.to_pandas(split_blocks=True, self_destruct=True)
+        except Exception as e:
+            print(f"  Warning: Could not load or parse cache at {symbol_path}. Error: {e}")
+            return pd.DataFrame()
+
+        if df.empty:
+            return pd.DataFrame()
+
+        # Shards are scanned in chronological file order and never overlap, so the index normally arrives sorted
+        # and unique. Both checks are a single O(N) pass; only a legacy or interrupted cache pays for a sort.
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index(kind='stable')
+        if not df.index.is_unique:
+            # On a duplicate timestamp the most recently written shard wins.
+            df = df[~df.index.duplicated(keep='last')]
+        return self._to_tick_dtypes(df)
+
+    def _cached_files(self, symbol_path: str, start_ts: pd.Timestamp, end_ts: pd.Timestamp) -> list[str]:
+        # Walk only the year=/month= partitions that intersect the range, in chronological order.
+        first_month = (start_ts.year, start_ts.month)
+        last_month = (end_ts.year, end_ts.month)
+
+        found = []
+        for year, year_path in self._scan_partitions(symbol_path, "year="):
+            if not first_month[0] <= year <= last_month[0]:
+                continue
+            for month, month_path in self._scan_partitions(year_path, "month="):
+                if not first_month <= (year, month) <= last_month:
+                    continue
+                with os.scandir(month_path) as entries:
+                    for entry in entries:
+                        if entry.is_file() and entry.name.endswith(".parquet") and not entry.name.startswith("."):
+                            found.append((year, month, entry.name, entry.path))
+
+        return [path for *_, path in sorted(found)]
+
+    def _scan_partitions(self, path: str, prefix: str) -> list[tuple[int, str]]:
+        if not os.path.isdir(path):
+            return []
+
+        partitions = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir() and entry.name.startswith(prefix) and entry.name[len(prefix):].isdigit():
+                    partitions.append((int(entry.name[len(prefix):]), entry.path))
+        return partitions
 
     def _save_local_data(self, symbol_path: str, df_to_save: pd.DataFrame):
-        for (year, month), group_df in df_to_save.groupby([df_to_save.index.year, df_to_save.index.month]):
-            month_dir = os.path.join(symbol_path, str(year))
-            os.makedirs(month_dir, exist_ok=True)
-            file_path = os.path.join(month_dir, f"{month:02d}.csv")
-            
-            if os.path.exists(file_path):
-                existing_df = pd.read_csv(file_path, index_col='timestamp', date_format='ISO8601')
-                    
-                combined_df = pd.concat([existing_df, group_df])
-                combined_df = combined_df[~combined_df.index.duplicated(keep='last')]
-                combined_df.sort_index(inplace=True)
-                combined_df.to_csv(file_path)
-            else:
-                group_df.to_csv(file_path)
+        df_to_save = self._to_tick_dtypes(df_to_save)
+        if df_to_save.empty:
+            return
+        if not df_to_save.index.is_monotonic_increasing:
+            df_to_save = df_to_save.sort_index(kind='stable')
+        if not df_to_save.index.is_unique:
+            # Shards must hold unique timestamps, on a duplicate the later tick wins.
+            df_to_save = df_to_save[~df_to_save.index.duplicated(keep='last')]
+
+        # On a sorted index every month is a contiguous run of rows, so a binary search per month boundary splits the
+        # frame into zero-copy slices without hashing every row the way groupby([year, month]) does.
+        index = df_to_save.index
+        month_starts = pd.date_range(index[0].normalize().replace(day=1), index[-1], freq='MS')
+        cuts = [0, *index.searchsorted(month_starts[1:]), len(df_to_save)]
+        months = [
+            (os.path.join(symbol_path, f"year={month_start.year}", f"month={month_start.month}"), df_to_save.iloc[start:stop])
+            for month_start, start, stop in zip(month_starts, cuts[:-1], cuts[1:])
+            if stop > start
+        ]
+
+        # Months are independent files and pyarrow releases the GIL while encoding and writing, so write them in parallel.
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_WRITES) as executor:
+            list(executor.map(lambda month: self._save_month(*month), months))
         print(f"  Saved/updated raw data in cache at: {symbol_path}")
 
+    def _save_month(self, month_dir: str, group_df: pd.DataFrame):
+        os.makedirs(month_dir, exist_ok=True)
+
+        # Shards never overlap each other, so only the newest ones can reach into the range of the new ticks.
+        overlapping_paths = [
+            file_path for file_path in sorted(glob.glob(os.path.join(month_dir, "*.parquet")))
+            if self._file_max_timestamp(file_path) >= group_df.index[0]
+        ]
+        if overlapping_paths:
+            # Only the row groups whose footer statistics reach the new ticks can hold the re-fetched window.
+            cached_df = pd.concat([self._read_row_groups_from(file_path, group_df.index[0]) for file_path in overlapping_paths])
+            # A shard from an older version or an interrupted merge can repeat a timestamp, the newest shard wins.
+            cached_df = cached_df[~cached_df.index.duplicated(keep='last')]
+            cached_max = cached_df.index.max()
+            refetched_df = group_df[group_df.index <= cached_max]
+            if refetched_df.equals(cached_df.reindex(index=refetched_df.index, columns=refetched_df.columns)):
+                # An update re-fetches a few minutes the cache already holds. When they add nothing, the cached shards
+                # stay as they are and only the newer ticks are written, as a shard of their own.
+                group_df = group_df[group_df.index > cached_max]
+                overlapping_paths = []
+                if group_df.empty:
+                    return
+            else:
+                # Merge the new ticks with just those shards. On a duplicate timestamp the new tick wins.
+                df = pd.concat([*[pd.read_parquet(file_path) for file_path in overlapping_paths], group_df])
+                df = df.sort_index(kind='stable')
+                group_df = self._to_tick_dtypes(df[~df.index.duplicated(keep='last')])
+
+        # Shard names sort by write time, and the new shard covers the newest range of the month.
+        file_path = os.path.join(month_dir, f"part-{time.time_ns()}-{uuid4().hex}.parquet")
+        tmp_path = os.path.join(month_dir, f".{os.path.basename(file_path)}.tmp")
+        group_df.to_parquet(tmp_path, engine='pyarrow', compression='snappy', row_group_size=CACHE_ROW_GROUP_SIZE)
+        os.replace(tmp_path, file_path)
+
+        for overlapping_path in overlapping_paths:
+            os.unlink(overlapping_path)
+
+        if len(glob.glob(os.path.join(month_dir, "part-*.parquet"))) > MAX_SHARDS_PER_MONTH:
+            self._compact(month_dir)
+
+    def _last_cached_timestamp(self, symbol_path: str):
+        for year, year_path in sorted(self._scan_partitions(symbol_path, "year="), reverse=True):
+            for month, month_path in sorted(self._scan_partitions(year_path, "month="), reverse=True):
+                max_ts = self._month_max_timestamp(month_path)
+                if max_ts is not None:
+                    return max_ts
+        return None
+
+    def _export_starts_at(
+            self,
+            output_path: str,
+            output_format: str,
+            symbol_path: str,
+            start_date: datetime,
+            end_date: datetime,
+            min_staleness: timedelta
+        ) -> bool:
+        # An export written for a different months_to_fetch holds a different range. It matches this run if it starts
+        # at the first cached tick of the range, or at most min_staleness before the range, as left by a run just before.
+        export_start = self._export_first_timestamp(output_path, output_format)
+        cached_start = self._first_cached_timestamp(symbol_path, start_date, end_date)
+        if export_start is None or cached_start is None:
+            return False
+        return start_date - min_staleness <= export_start <= cached_start
+
+    def _export_first_timestamp(self, output_path: str, output_format: str):
+        # Read only the first tick of an export, from the parquet footer or the first CSV data line.
+        try:
+            if output_format == 'parquet':
+                metadata = pq.read_metadata(output_path)
+                if metadata.num_row_groups == 0:
+                    return None
+                column_index = metadata.schema.to_arrow_schema().get_field_index('timestamp')
+                stats = metadata.row_group(0).column(column_index).statistics
+                if stats is None or not stats.has_min_max:
+                    return None
+                return pd.Timestamp(stats.min)
+
+            with open(output_path) as f:
+                f.readline()
+                first_line = f.readline()
+            return pd.Timestamp(first_line.split(',', 1)[0]) if first_line else None
+        except Exception:
+            return None
+
+    def _first_cached_timestamp(self, symbol_path: str, start_date: datetime, end_date: datetime):
+        start_ts = pd.Timestamp(start_date).tz_convert('UTC')
+        file_paths = self._cached_files(symbol_path, start_ts, pd.Timestamp(end_date).tz_convert('UTC'))
+        if not file_paths:
+            return None
+
+        # Files are in chronological order, so the scan stops in the first row group that reaches the range.
+        first = ds.dataset(file_paths, format='parquet').head(1, columns=['timestamp'], filter=ds.field('timestamp') >= start_ts)
+        if first.num_rows == 0:
+            return None
+        return pd.Timestamp(first.column('timestamp')[0].as_py())
+
+    def _month_max_timestamp(self, month_dir: str):
+        max_ts = None
+        for file_path in glob.glob(os.path.join(month_dir, "*.parquet")):
+            file_max = self._file_max_timestamp(file_path)
+            if pd.notna(file_max) and (max_ts is None or file_max > max_ts):
+                max_ts = file_max
+        return max_ts
+
+    def _file_max_timestamp(self, file_path: str) -> pd.Timestamp:
+        # Read the newest timestamp of a cache file from its parquet footer instead of the data itself.
+        row_group_maxima = self._row_group_max_timestamps(pq.read_metadata(file_path))
+        if None in row_group_maxima:
+            return pd.read_parquet(file_path, columns=['timestamp']).index.max()
+        return max(row_group_maxima, default=pd.NaT)
+
+    def _read_row_groups_from(self, file_path: str, start_ts: pd.Timestamp) -> pd.DataFrame:
+        # Decode only the row groups of a cache file that reach start_ts, the older ones are skipped via the footer.
+        parquet_file = pq.ParquetFile(file_path)
+        row_groups = [
+            row_group for row_group, row_group_max in enumerate(self._row_group_max_timestamps(parquet_file.metadata))
+            if row_group_max is None or row_group_max >= start_ts
+        ]
+        return parquet_file.read_row_groups(row_groups, use_pandas_metadata=True).to_pandas()
+
+    def _row_group_max_timestamps(self, metadata: pq.FileMetaData) -> list:
+        # Newest timestamp of each row group from its statistics, None where a row group has none.
+        column_index = metadata.schema.to_arrow_schema().get_field_index('timestamp')
+        maxima = []
+        for row_group in range(metadata.num_row_groups):
+            stats = metadata.row_group(row_group).column(column_index).statistics
+            maxima.append(pd.Timestamp(stats.max) if stats is not None and stats.has_min_max else None)
+        return maxima
+
+    def _compact(self, month_dir: str):
+        shard_paths = glob.glob(os.path.join(month_dir, "part-*.parquet"))
+
+        # compacted.parquet sorts before the shards, so it is read first and the shards override it.
+        df = pd.read_parquet(month_dir, engine='pyarrow')
+        df = df.sort_index(kind='stable')
+        df = self._to_tick_dtypes(df[~df.index.duplicated(keep='last')])
+
+        tmp_path = os.path.join(month_dir, ".compacted.parquet.tmp")
+        df.to_parquet(tmp_path, engine='pyarrow', compression='snappy', row_group_size=CACHE_ROW_GROUP_SIZE)
+        os.replace(tmp_path, os.path.join(month_dir, "compacted.parquet"))
+
+        for shard_path in shard_paths:
+            os.unlink(shard_path)
+
+    def _migrate_legacy_csv_cache(self, symbol_path: str):
+        # Older versions cached each month as symbol_path/YYYY/MM.csv, move those into the parquet dataset once.
+        for file_path in sorted(glob.glob(os.path.join(symbol_path, "[0-9][0-9][0-9][0-9]", "[0-9][0-9].csv"))):
+            try:
+                # Arrow's multithreaded C++ parser with a fixed schema, no per-row Python date parsing or dtype inference.
+                # Timestamps go through Arrow's ISO8601 fast path only; its strptime parsers cannot read the
+                # fractional seconds pandas wrote (e.g. 2025-04-25 06:31:49.984000+00:00).
+                table = pa_csv.read_csv(
+                    file_path,
+                    convert_options=pa_csv.ConvertOptions(
+                        column_types=LEGACY_CSV_COLUMN_TYPES,
+                        timestamp_parsers=[pa_csv.ISO8601],
+                    ),
+                )
+                df = table.to_pandas(split_blocks=True, self_destruct=True).set_index('timestamp')
+                if not df.empty:
+                    self._save_local_data(symbol_path, df)
+                os.remove(file_path)
+            except Exception as e:
+                print(f"  Warning: Could not migrate legacy cache file {file_path}. Error: {e}")
+                continue
+
+            year_dir = os.path.dirname(file_path)
+            if not os.listdir(year_dir):
+                os.rmdir(year_dir)
+
     def _fetch_from_dukascopy(self, symbol: str, start_date: datetime, end_date: datetime) -> pd.DataFrame:
-        df = dukascopy_python.fetch(
+        start_ts = pd.Timestamp(start_date)
+        end_ts = pd.Timestamp(end_date)
+
+        # Split the range on month boundaries so the months can be downloaded in parallel.
+        month_starts = pd.date_range(start_ts, end_ts, freq='MS', normalize=True)
+        boundaries = [start_ts, *[ts for ts in month_starts if start_ts < ts < end_ts], end_ts]
+        chunks = list(zip(boundaries[:-1], boundaries[1:]))
+
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CHUNKS) as executor:
+            dfs = list(executor.map(lambda chunk: self._fetch_chunk(symbol, *chunk), chunks))
+
+        # A tick exactly on a month boundary is returned by both neighbouring chunks, and the feed can stamp two ticks
+        # with the same millisecond. A single chunk is cleaned the same way, the cache relies on a unique index.
+        df = self._to_tick_dtypes(pd.concat(dfs) if len(dfs) > 1 else dfs[0])
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index(kind='stable')
+        return df[~df.index.duplicated(keep='last')]
+
+    def _to_tick_dtypes(self, df: pd.DataFrame) -> pd.DataFrame:
+        # Volumes carry a few significant digits and ticks are stamped to the millisecond, so float32 volumes and a
+        # datetime64[ms] index shrink the bytes cached, read back and held in memory without losing information.
+        df = df.astype({column: dtype for column, dtype in TICK_DTYPES.items() if column in df.columns})
+        df.index = pd.DatetimeIndex(df.index).as_unit('ms')
+        return df.rename_axis('timestamp')
+
+    def _fetch_chunk(self, symbol: str, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        # dukascopy_python retries a failed page itself and resumes from the last tick it got, so no retry loop here
+        # that would restart the whole month.
+        return dukascopy_python.fetch(
             symbol,
             dukascopy_python.INTERVAL_TICK,
             dukascopy_python.OFFER_SIDE_BID,
             start_date,
             end_date,
         )
-        return df
 
     def set_broker_timezone(self, timezone_name: str):
         try:
-            pytz.timezone(timezone_name)
+            ZoneInfo(timezone_name)
             self.broker_timezone = timezone_name
             print(f"Default broker timezone set to: {timezone_name}")
-        except pytz.exceptions.UnknownTimeZoneError:
+        except (ZoneInfoNotFoundError, ValueError):
             print(f"Unknown timezone: {timezone_name}")
\ No newline at end of file
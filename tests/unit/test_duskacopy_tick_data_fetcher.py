@@ -1,10 +1,15 @@
+import re
 import pytest
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import pytz
+import requests
+import dukascopy_python
+import pyarrow.parquet as pq
 from unittest.mock import Mock, patch, MagicMock, mock_open, call
 
+import dukascopy_tick_data_fetcher
 from dukascopy_tick_data_fetcher import Dukascopy_Tick_Data_Fetcher
 
 class TestDukascopyTickDataFetcher:
@@ -55,6 +60,13 @@ class TestDukascopyTickDataFetcher:
         timestamps = pd.date_range('2025-04-25 00:00:00', '2025-04-25 23:59:59', periods=10, tz='UTC')
         return pd.DataFrame(data, index=timestamps)
 
+    @staticmethod
+    def _as_tick_dtypes(df):
+        """The dtypes the fetcher normalises tick data to"""
+        expected = df.astype({column: dtype for column, dtype in dukascopy_tick_data_fetcher.TICK_DTYPES.items() if column in df.columns})
+        expected.index = expected.index.as_unit('ms')
+        return expected.rename_axis('timestamp')
+
     def test_init_default_timezone(self, fetcher):
         """Test that fetcher initializes with correct default timezone"""
         assert fetcher.broker_timezone == "Europe/Helsinki"
@@ -72,79 +84,337 @@ class TestDukascopyTickDataFetcher:
         captured = capsys.readouterr()
         assert "Unknown timezone" in captured.out
 
-    @patch('os.path.exists')
-    @patch('pandas.read_csv')
-    def test_load_local_data_empty_cache(self, mock_read_csv, mock_exists, fetcher):
+    def test_load_local_data_empty_cache(self, fetcher, tmp_path):
         """Test loading data when no local cache exists"""
-        mock_exists.return_value = False
-        
         start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
         end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
         
-        result = fetcher._load_local_data("test_path", start_date, end_date)
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
         
         assert result.empty
-        mock_read_csv.assert_not_called()
 
-    @patch('os.path.exists')
-    @patch('pandas.read_csv')
-    def test_load_local_data_with_existing_files(self, mock_read_csv, mock_exists, fetcher, sample_tick_data):
+    def test_load_local_data_with_existing_files(self, fetcher, tmp_path, sample_tick_data):
         """Test loading data from existing local files"""
-        mock_exists.return_value = True
-        mock_read_csv.return_value = sample_tick_data
+        fetcher._save_local_data(str(tmp_path), sample_tick_data)
         
         start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
         end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
         
-        result = fetcher._load_local_data("test_path", start_date, end_date)
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
         
         assert not result.empty
         assert len(result) == len(sample_tick_data)
-        mock_read_csv.assert_called()
+        assert list(result.columns) == list(sample_tick_data.columns)
+        assert result.index.name == 'timestamp'
+
+    def test_load_local_data_filters_date_range(self, fetcher, tmp_path, sample_tick_data):
+        """Test that only ticks inside the requested range are returned"""
+        fetcher._save_local_data(str(tmp_path), sample_tick_data)
+        
+        start_date = sample_tick_data.index[1]
+        end_date = sample_tick_data.index[3]
+        
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
+        
+        assert len(result) == 3
+        assert result.index[0] == start_date
+        assert result.index[-1] == end_date
+
+    def test_load_local_data_only_reads_partitions_in_range(self, fetcher, tmp_path):
+        """Test that months outside the range are skipped and the rest come back in order"""
+        timestamps = pd.DatetimeIndex(['2024-10-15', '2024-11-15', '2024-12-15', '2025-01-15', '2025-02-15'], tz='UTC')
+        fetcher._save_local_data(str(tmp_path), pd.DataFrame({'bidPrice': [1.0, 2.0, 3.0, 4.0, 5.0]}, index=timestamps))
+        
+        start_date = datetime(2024, 11, 1, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 1, 31, tzinfo=pytz.UTC)
+        
+        files = fetcher._cached_files(str(tmp_path), pd.Timestamp(start_date), pd.Timestamp(end_date))
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
+        
+        assert len(files) == 3
+        assert list(result['bidPrice']) == [2.0, 3.0, 4.0]
+
+    def test_load_local_data_skips_row_groups_out_of_range(self, fetcher, tmp_path, sample_tick_data):
+        """Test that cache files are split into row groups that the date filter can skip"""
+        with patch('dukascopy_tick_data_fetcher.CACHE_ROW_GROUP_SIZE', 2):
+            fetcher._save_local_data(str(tmp_path), sample_tick_data)
+        
+        shard = next((tmp_path / "year=2025" / "month=4").glob("*.parquet"))
+        assert pq.read_metadata(shard).num_row_groups == 3
+        
+        result = fetcher._load_local_data(str(tmp_path), sample_tick_data.index[4], sample_tick_data.index[4])
+        
+        assert len(result) == 1
+
+    def test_load_local_data_sorts_out_of_order_shards(self, fetcher, tmp_path, sample_tick_data):
+        """Test that shards written out of chronological order are still returned sorted and unique"""
+        month_dir = tmp_path / "year=2025" / "month=4"
+        month_dir.mkdir(parents=True)
+        cached = sample_tick_data.rename_axis('timestamp')
+        cached.iloc[2:].to_parquet(month_dir / "part-1.parquet")
+        cached.iloc[:3].to_parquet(month_dir / "part-2.parquet")
+        
+        start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
+        
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
+        
+        assert result.index.is_monotonic_increasing
+        assert result.index.is_unique
+        assert len(result) == len(sample_tick_data)
+
+    def test_load_local_data_keeps_tick_dtypes(self, fetcher, tmp_path, sample_tick_data):
+        """Test that ticks keep float64 prices, float32 volumes and millisecond timestamps through the cache"""
+        fetcher._save_local_data(str(tmp_path), sample_tick_data)
+        
+        start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
+        
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
+        
+        assert list(result.dtypes) == ['float64', 'float64', 'float32', 'float32']
+        assert result.index.dtype == 'datetime64[ms, UTC]'
+        pd.testing.assert_frame_equal(result, self._as_tick_dtypes(sample_tick_data), check_freq=False)
+        
+        fetcher._write_csv(result.tz_convert("Europe/Helsinki"), str(tmp_path / "out.csv"))
+        assert "09:31:49.984000+03:00,1.90169,1.9021,0.54,0.12" in (tmp_path / "out.csv").read_text()
 
-    @patch('os.path.exists')
-    @patch('pandas.read_csv')
-    def test_load_local_data_corrupted_file(self, mock_read_csv, mock_exists, fetcher, capsys):
+    def test_load_local_data_keeps_high_prices_exact(self, fetcher, tmp_path):
+        """Test that index and crypto prices above float32's exact range survive the cache unchanged"""
+        ticks = pd.DataFrame(
+            {'bidPrice': [44123.457, 140523.46], 'askPrice': [44123.458, 140523.47], 'bidVolume': [1.0, 0.5], 'askVolume': [1.0, 0.5]},
+            index=pd.DatetimeIndex(['2025-04-25 06:31:49.984', '2025-04-25 06:31:50.484'], tz='UTC')
+        )
+        fetcher._save_local_data(str(tmp_path), ticks)
+        
+        start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
+        
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
+        
+        assert list(result['bidPrice']) == [44123.457, 140523.46]
+        assert list(result['askPrice']) == [44123.458, 140523.47]
+
+    def test_load_local_data_corrupted_file(self, fetcher, tmp_path, capsys):
         """Test handling of corrupted local files"""
-        mock_exists.return_value = True
-        mock_read_csv.side_effect = Exception("File corrupted")
+        month_dir = tmp_path / "year=2025" / "month=4"
+        month_dir.mkdir(parents=True)
+        (month_dir / "part-0.parquet").write_bytes(b"File corrupted")
         
         start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
         end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
         
-        result = fetcher._load_local_data("test_path", start_date, end_date)
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
         
         assert result.empty
         captured = capsys.readouterr()
         assert "Warning: Could not load or parse" in captured.out
 
-    @patch('os.makedirs')
-    @patch('os.path.exists')
-    @patch('pandas.read_csv')
-    @patch('pandas.DataFrame.to_csv')
-    def test_save_local_data_new_file(self, mock_to_csv, mock_read_csv, mock_exists, mock_makedirs, fetcher, sample_tick_data):
-        """Test saving data to new local file"""
-        mock_exists.return_value = False
+    def test_migrate_legacy_csv_cache(self, fetcher, tmp_path, sample_tick_data):
+        """Test that a cache written by the old YYYY/MM.csv layout is moved into the parquet dataset"""
+        legacy_dir = tmp_path / "2025"
+        legacy_dir.mkdir()
+        sample_tick_data.rename_axis('timestamp').to_csv(legacy_dir / "04.csv")
         
-        fetcher._save_local_data("test_path", sample_tick_data)
+        start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
         
-        mock_makedirs.assert_called()
-        mock_to_csv.assert_called()
+        fetcher._migrate_legacy_csv_cache(str(tmp_path))
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
+        
+        assert len(result) == len(sample_tick_data)
+        assert not legacy_dir.exists()
+        assert list((tmp_path / "year=2025" / "month=4").glob("*.parquet"))
 
-    @patch('os.makedirs')
-    @patch('os.path.exists')
-    @patch('pandas.read_csv')
-    @patch('pandas.DataFrame.to_csv')
-    def test_save_local_data_existing_file(self, mock_to_csv, mock_read_csv, mock_exists, mock_makedirs, fetcher, sample_tick_data):
+    def test_migrate_legacy_csv_cache_timestamp_layouts(self, fetcher, tmp_path):
+        """Test that legacy timestamps with and without fractional seconds are parsed to the millisecond"""
+        legacy_dir = tmp_path / "2025"
+        legacy_dir.mkdir()
+        (legacy_dir / "04.csv").write_text(
+            "timestamp,bidPrice,askPrice,bidVolume,askVolume\n"
+            "2025-04-25 06:31:49.984000+00:00,1.90169,1.9021,0.54,0.12\n"
+            "2025-04-25 06:31:50+00:00,1.90167,1.90208,0.12,0.12\n"
+        )
+        
+        start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
+        
+        fetcher._migrate_legacy_csv_cache(str(tmp_path))
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
+        
+        assert list(result.index) == [
+            pd.Timestamp('2025-04-25 06:31:49.984', tz='UTC'),
+            pd.Timestamp('2025-04-25 06:31:50', tz='UTC'),
+        ]
+
+    def test_save_local_data_new_file(self, fetcher, tmp_path, sample_tick_data):
+        """Test saving data to new local file"""
+        fetcher._save_local_data(str(tmp_path), sample_tick_data)
+        
+        month_dir = tmp_path / "year=2025" / "month=4"
+        assert len(list(month_dir.glob("*.parquet"))) == 1
+
+    def test_save_local_data_existing_file(self, fetcher, tmp_path, sample_tick_data):
         """Test saving data to existing local file (should merge)"""
-        mock_exists.return_value = True
-        mock_read_csv.return_value = sample_tick_data.iloc[:2]  # Existing partial data
+        fetcher._save_local_data(str(tmp_path), sample_tick_data.iloc[:2])  # Existing partial data
+        
+        updated = sample_tick_data.copy()
+        updated['bidPrice'] = 2.0
+        fetcher._save_local_data(str(tmp_path), updated)
+        
+        start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
         
-        fetcher._save_local_data("test_path", sample_tick_data)
+        assert len(result) == len(sample_tick_data)
+        assert (result['bidPrice'] == 2.0).all()  # Newest write wins on duplicate timestamps
+
+    def test_save_local_data_multiple_months(self, fetcher, tmp_path):
+        """Test that ticks spanning several months are written to one partition per month"""
+        timestamps = pd.DatetimeIndex(['2025-02-15', '2025-03-15', '2025-04-15'], tz='UTC')
+        fetcher._save_local_data(str(tmp_path), pd.DataFrame({'bidPrice': [1.0, 2.0, 3.0]}, index=timestamps))
+        
+        for month in (2, 3, 4):
+            assert len(list((tmp_path / "year=2025" / f"month={month}").glob("*.parquet"))) == 1
+
+    def test_save_local_data_unsorted_across_years(self, fetcher, tmp_path):
+        """Test that unsorted ticks spanning a year end and an empty month land in the right partitions"""
+        timestamps = pd.DatetimeIndex(['2025-02-01', '2024-12-31 23:59:59.999', '2025-02-28 23:59:59.999', '2024-12-01'], tz='UTC')
+        fetcher._save_local_data(str(tmp_path), pd.DataFrame({'bidPrice': [3.0, 2.0, 4.0, 1.0]}, index=timestamps))
+        
+        assert not (tmp_path / "year=2025" / "month=1").exists()
+        december = pd.read_parquet(next((tmp_path / "year=2024" / "month=12").glob("*.parquet")))
+        february = pd.read_parquet(next((tmp_path / "year=2025" / "month=2").glob("*.parquet")))
+        assert list(december['bidPrice']) == [1.0, 2.0]
+        assert list(february['bidPrice']) == [3.0, 4.0]
+
+    def test_save_local_data_appends_without_overlap(self, fetcher, tmp_path, sample_tick_data):
+        """Test that ticks strictly after the cached ones are appended as a new shard"""
+        fetcher._save_local_data(str(tmp_path), sample_tick_data.iloc[:2])
+        
+        with patch.object(fetcher, '_compact') as mock_compact:
+            fetcher._save_local_data(str(tmp_path), sample_tick_data.iloc[2:])
+        
+        mock_compact.assert_not_called()
+        month_dir = tmp_path / "year=2025" / "month=4"
+        assert len(list(month_dir.glob("part-*.parquet"))) == 2
+
+    def test_save_local_data_appends_after_matching_overlap(self, fetcher, tmp_path, sample_tick_data):
+        """Test that re-fetched ticks the cache already holds leave it untouched and only newer ticks are appended"""
+        fetcher._save_local_data(str(tmp_path), sample_tick_data.iloc[:3])
+        month_dir = tmp_path / "year=2025" / "month=4"
+        first_shard = min(month_dir.glob("*.parquet"))
+        
+        fetcher._save_local_data(str(tmp_path), sample_tick_data.iloc[1:])
+        
+        shards = sorted(month_dir.glob("*.parquet"))
+        assert len(shards) == 2
+        assert shards[0] == first_shard
+        assert len(pd.read_parquet(shards[0])) == 3
+        assert len(pd.read_parquet(shards[1])) == 2
+
+    def test_save_local_data_reads_only_overlapping_row_groups(self, fetcher, tmp_path):
+        """Test that checking the re-fetched overlap decodes only the row groups it reaches"""
+        ticks = pd.DataFrame({'bidPrice': [1.0] * 5}, index=pd.date_range('2025-04-01', periods=5, freq='1D', tz='UTC'))
+        with patch('dukascopy_tick_data_fetcher.CACHE_ROW_GROUP_SIZE', 2):
+            fetcher._save_local_data(str(tmp_path), ticks)
+        
+        with patch.object(pq.ParquetFile, 'read_row_groups', autospec=True, side_effect=pq.ParquetFile.read_row_groups) as mock_read:
+            fetcher._save_local_data(str(tmp_path), pd.concat([ticks.iloc[-1:], pd.DataFrame({'bidPrice': [1.0]}, index=pd.DatetimeIndex(['2025-04-06'], tz='UTC'))]))
+        
+        assert mock_read.call_args[0][1] == [2]
+        assert len(list((tmp_path / "year=2025" / "month=4").glob("*.parquet"))) == 2
+
+    def test_save_local_data_deduplicates_new_ticks(self, fetcher, tmp_path, sample_tick_data):
+        """Test that ticks sharing a timestamp are written once, the later one winning"""
+        duplicated = pd.concat([sample_tick_data, sample_tick_data.iloc[-1:].assign(bidPrice=2.0)])
+        
+        fetcher._save_local_data(str(tmp_path), duplicated)
+        
+        written = pd.read_parquet(next((tmp_path / "year=2025" / "month=4").glob("*.parquet")))
+        assert written.index.is_unique
+        assert written['bidPrice'].iloc[-1] == 2.0
+
+    def test_save_local_data_overlaps_duplicate_cached_tail(self, fetcher, tmp_path, sample_tick_data):
+        """Test that a cached shard repeating a timestamp near its tail does not break the next overlapping save"""
+        month_dir = tmp_path / "year=2025" / "month=4"
+        month_dir.mkdir(parents=True)
+        cached = self._as_tick_dtypes(pd.concat([sample_tick_data.iloc[:4], sample_tick_data.iloc[3:4]]))
+        cached.to_parquet(month_dir / "part-1.parquet")
+        
+        fetcher._save_local_data(str(tmp_path), sample_tick_data.iloc[2:])
+        
+        start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
+        
+        pd.testing.assert_frame_equal(result, self._as_tick_dtypes(sample_tick_data), check_freq=False)
+
+    def test_save_local_data_merges_on_overlap(self, fetcher, tmp_path, sample_tick_data):
+        """Test that overlapping ticks that change the cache are merged with only the shards they overlap"""
+        fetcher._save_local_data(str(tmp_path), sample_tick_data.iloc[:2])
+        fetcher._save_local_data(str(tmp_path), sample_tick_data.iloc[2:4])
+        month_dir = tmp_path / "year=2025" / "month=4"
+        first_shard = min(month_dir.glob("*.parquet"))
+        
+        updated = sample_tick_data.iloc[3:].copy()
+        updated['bidPrice'] = 2.0
+        fetcher._save_local_data(str(tmp_path), updated)
+        
+        shards = sorted(month_dir.glob("*.parquet"))
+        assert len(shards) == 2
+        assert shards[0] == first_shard  # Untouched, it ends before the new ticks
+        assert list(pd.read_parquet(shards[1])['bidPrice']) == pytest.approx([1.90167, 2.0, 2.0])
+
+    def test_save_local_data_compacts_shards(self, fetcher, tmp_path, sample_tick_data):
+        """Test that a month is compacted into a single file once it has too many shards"""
+        ticks = pd.DataFrame(
+            {'bidPrice': [1.0] * 9},
+            index=pd.date_range('2025-04-01', periods=9, freq='1D', tz='UTC')
+        )
+        for i in range(len(ticks)):
+            fetcher._save_local_data(str(tmp_path), ticks.iloc[i:i + 1])
+        
+        month_dir = tmp_path / "year=2025" / "month=4"
+        assert [p.name for p in month_dir.glob("*.parquet")] == ["compacted.parquet"]
+        
+        updated = ticks.iloc[-3:].copy()
+        updated['bidPrice'] = 2.0
+        fetcher._save_local_data(str(tmp_path), updated)
+        
+        start_date = datetime(2025, 4, 1, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 4, 30, tzinfo=pytz.UTC)
+        result = fetcher._load_local_data(str(tmp_path), start_date, end_date)
         
-        mock_makedirs.assert_called()
-        mock_read_csv.assert_called()
-        mock_to_csv.assert_called()
+        assert list(result['bidPrice']) == [1.0] * 6 + [2.0] * 3
+
+    def test_dukascopy_requests_share_one_session(self, fetcher):
+        """Test that dukascopy_python's HTTP requests go through one pooled session"""
+        session = dukascopy_tick_data_fetcher._install_shared_http_session()
+        
+        with patch.object(session, 'get') as mock_get:
+            dukascopy_python.requests.get("https://freeserv.dukascopy.com/2.0/index.php", params={})
+        
+        mock_get.assert_called_once()
+        Dukascopy_Tick_Data_Fetcher()  # Further instances reuse the same session
+        assert dukascopy_tick_data_fetcher._install_shared_http_session() is session
+        assert dukascopy_python.requests.exceptions is requests.exceptions
+
+    def test_dukascopy_requests_are_rate_limited(self, fetcher):
+        """Test that request starts beyond the rate limit wait for the period to pass"""
+        limiter = dukascopy_tick_data_fetcher._RateLimiter(max_rate=2, time_period=2.0)
+        pooled = dukascopy_tick_data_fetcher._PooledRequests(Mock(), limiter)
+        clock = [100.0]
+        
+        def fake_sleep(seconds):
+            clock[0] += seconds
+        
+        with patch('time.monotonic', side_effect=lambda: clock[0]), patch('time.sleep', side_effect=fake_sleep) as mock_sleep:
+            for _ in range(3):
+                pooled.get("https://freeserv.dukascopy.com/2.0/index.php", params={})
+        
+        mock_sleep.assert_called_once_with(2.0)
+        assert isinstance(dukascopy_python.requests._limiter, dukascopy_tick_data_fetcher._RateLimiter)
 
     @patch('dukascopy_python.fetch')
     def test_fetch_from_dukascopy_success(self, mock_fetch, fetcher, sample_tick_data):
@@ -157,7 +427,24 @@ class TestDukascopyTickDataFetcher:
         result = fetcher._fetch_from_dukascopy("EUR/USD", start_date, end_date)
         
         mock_fetch.assert_called_once()
-        pd.testing.assert_frame_equal(result, sample_tick_data)
+        pd.testing.assert_frame_equal(result, self._as_tick_dtypes(sample_tick_data))
+
+    @patch('dukascopy_python.fetch')
+    def test_fetch_from_dukascopy_single_chunk_is_deduplicated(self, mock_fetch, fetcher):
+        """Test that a range within one month is sorted and de-duplicated to the millisecond like a multi-month one"""
+        mock_fetch.return_value = pd.DataFrame(
+            {'bidPrice': [3.0, 1.0, 2.0]},
+            index=pd.DatetimeIndex(['2025-04-25 10:00:01', '2025-04-25 10:00:00.000100', '2025-04-25 10:00:00.000900'], tz='UTC')
+        )
+        
+        start_date = datetime(2025, 4, 25, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 4, 26, tzinfo=pytz.UTC)
+        
+        result = fetcher._fetch_from_dukascopy("EUR/USD", start_date, end_date)
+        
+        mock_fetch.assert_called_once()
+        assert list(result.index) == [pd.Timestamp('2025-04-25 10:00:00', tz='UTC'), pd.Timestamp('2025-04-25 10:00:01', tz='UTC')]
+        assert list(result['bidPrice']) == [2.0, 3.0]
 
     @patch('dukascopy_python.fetch')
     def test_fetch_from_dukascopy_failure(self, mock_fetch, fetcher):
@@ -169,34 +456,54 @@ class TestDukascopyTickDataFetcher:
         
         with pytest.raises(Exception, match="API Error"):
             fetcher._fetch_from_dukascopy("EUR/USD", start_date, end_date)
+        
+        mock_fetch.assert_called_once()  # dukascopy_python has already retried the failing page
+
+    @patch('dukascopy_python.fetch')
+    def test_fetch_from_dukascopy_month_chunks(self, mock_fetch, fetcher):
+        """Test that a multi-month range is fetched as one request per month"""
+        def fake_fetch(symbol, interval, offer_side, start, end):
+            # Include the chunk end so the month boundary tick is returned twice
+            return pd.DataFrame({'bidPrice': [1.0, 1.0]}, index=pd.DatetimeIndex([start, end]))
+        mock_fetch.side_effect = fake_fetch
+        
+        start_date = datetime(2025, 4, 15, tzinfo=pytz.UTC)
+        end_date = datetime(2025, 6, 10, tzinfo=pytz.UTC)
+        
+        result = fetcher._fetch_from_dukascopy("EUR/USD", start_date, end_date)
+        
+        requested = sorted((c.args[3], c.args[4]) for c in mock_fetch.call_args_list)
+        assert requested == [
+            (pd.Timestamp('2025-04-15', tz='UTC'), pd.Timestamp('2025-05-01', tz='UTC')),
+            (pd.Timestamp('2025-05-01', tz='UTC'), pd.Timestamp('2025-06-01', tz='UTC')),
+            (pd.Timestamp('2025-06-01', tz='UTC'), pd.Timestamp('2025-06-10', tz='UTC')),
+        ]
+        assert result.index.is_monotonic_increasing
+        assert result.index.is_unique
+        assert len(result) == 4
 
     @patch('os.makedirs')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_save_local_data')
-    def test_get_no_local_data_fresh_download(self, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, sample_tick_data):
+    def test_get_no_local_data_fresh_download(self, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, tmp_path, sample_tick_data):
         """Test complete fresh download when no local data exists"""
         # Setup mocks
         mock_load.return_value = pd.DataFrame()  # Empty cache
         mock_fetch.return_value = sample_tick_data
         
         symbols = [("EUR/USD", "EURUSD")]
-        output_dir = "test_output"
         
-        fetcher.get(months_to_fetch=1, symbols=symbols, output_dir=output_dir)
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
         
         mock_load.assert_called_once()
         mock_fetch.assert_called_once()
         mock_save.assert_called_once()
 
-    @patch('pandas.DataFrame.to_csv')
-    @patch('os.makedirs')
-    @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
-    @patch.object(Dukascopy_Tick_Data_Fetcher, '_save_local_data')
-    def test_get_complete_local_data_no_download(self, mock_save, mock_fetch, mock_load, mock_makedirs, mock_to_csv, fetcher, complete_day_data, sample_tick_data):
-        """Test that when local data exists, it re-fetches the last day for completeness"""
-        # Setup: local data exists
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_write_csv')
+    def test_get_complete_local_data_no_download(self, mock_write_csv, mock_fetch, fetcher, tmp_path, complete_day_data):
+        """Test that when stale local data exists, it re-fetches its tail for completeness"""
         current_time = pd.Timestamp.now(tz=pytz.UTC)
         complete_data = complete_day_data.copy()
         complete_data.index = pd.date_range(
@@ -205,61 +512,123 @@ class TestDukascopyTickDataFetcher:
             periods=len(complete_data), 
             tz='UTC'
         )
-        
-        mock_load.return_value = complete_data
-        # Fix: Return actual data so _save_local_data gets called
-        mock_fetch.return_value = sample_tick_data  # Return actual data
+        fetcher._save_local_data(str(tmp_path / "EUR_USD"), complete_data)
+        last_cached = complete_data.index[-1].floor('ms')
+        mock_fetch.return_value = pd.DataFrame({'bidPrice': [2.0]}, index=pd.DatetimeIndex([current_time - relativedelta(hours=1)]))
         
         symbols = [("EUR/USD", "EURUSD")]
-        output_dir = "test_output"
         
-        fetcher.get(months_to_fetch=1, symbols=symbols, output_dir=output_dir)
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
         
-        mock_load.assert_called_once()
         mock_fetch.assert_called_once()  # Should fetch to ensure completeness
-        mock_save.assert_called_once()   # Should save the fetched data
+        assert mock_fetch.call_args[0][1] == last_cached - pd.Timedelta(minutes=5)
+        assert len(mock_write_csv.call_args[0][0]) == len(complete_data) + 1
+
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_write_csv')
+    def test_get_fresh_local_data_no_download(self, mock_write_csv, mock_fetch, fetcher, tmp_path):
+        """Test that local data newer than min_staleness is used without fetching"""
+        recent = pd.Timestamp.now(tz=pytz.UTC) - relativedelta(minutes=10)
+        fetcher._save_local_data(str(tmp_path / "EUR_USD"), pd.DataFrame({'bidPrice': [1.0]}, index=pd.DatetimeIndex([recent])))
+        
+        symbols = [("EUR/USD", "EURUSD")]
+        
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
+        
+        mock_fetch.assert_not_called()
+        mock_write_csv.assert_called_once()
+        assert len(mock_write_csv.call_args[0][0]) == 1
 
-    @patch('os.makedirs')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
-    @patch.object(Dukascopy_Tick_Data_Fetcher, '_save_local_data')
-    def test_get_incomplete_day_redownload(self, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, partial_day_data, sample_tick_data):
-        """Test that incomplete day triggers re-download from start of that day"""
-        # Setup: partial day data exists
-        mock_load.return_value = partial_day_data
+    def test_get_skips_symbol_when_export_is_current(self, mock_fetch, mock_load, fetcher, tmp_path, capsys):
+        """Test that a fresh cache with an export written after it skips the whole symbol"""
+        recent = (pd.Timestamp.now(tz=pytz.UTC) - relativedelta(minutes=10)).floor('s')
+        fetcher._save_local_data(str(tmp_path / "EUR_USD"), pd.DataFrame({'bidPrice': [1.0]}, index=pd.DatetimeIndex([recent])))
+        (tmp_path / "EURUSD-Europe_Helsinki.csv").write_text(f"timestamp,bidPrice\n{recent.tz_convert('Europe/Helsinki')},1.0\n")
+        
+        symbols = [("EUR/USD", "EURUSD")]
+        
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
+        
+        mock_load.assert_not_called()
+        mock_fetch.assert_not_called()
+        assert "up-to-date. Nothing to do." in capsys.readouterr().out
+
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
+    def test_get_reexports_when_months_to_fetch_changes(self, mock_fetch, fetcher, tmp_path):
+        """Test that a fresh export of a longer range is rewritten when fewer months are requested"""
+        now = pd.Timestamp.now(tz=pytz.UTC)
+        daily = pd.date_range(now - relativedelta(months=3), now - relativedelta(minutes=10), freq='1D', tz='UTC')
+        fetcher._save_local_data(str(tmp_path / "EUR_USD"), pd.DataFrame({'bidPrice': 1.0}, index=daily.union([now - relativedelta(minutes=10)])))
+        output_path = tmp_path / "EURUSD-Europe_Helsinki.parquet"
+        
+        symbols = [("EUR/USD", "EURUSD")]
+        
+        fetcher.get(months_to_fetch=3, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path), output_format='parquet')
+        assert pd.read_parquet(output_path).index[0] < now - relativedelta(months=2)
+        
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path), output_format='parquet')
+        assert pd.read_parquet(output_path).index[0] >= now - relativedelta(months=1)
+        
+        fetcher.get(months_to_fetch=3, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path), output_format='parquet')
+        assert pd.read_parquet(output_path).index[0] < now - relativedelta(months=2)
+        mock_fetch.assert_not_called()
+
+    def test_get_refreshes_append_a_shard(self, fetcher, tmp_path):
+        """Test that consecutive refreshes add a shard for the new ticks instead of rewriting the cached month"""
+        def fake_feed(symbol, interval, offer_side, start, end):
+            # One tick per minute plus one at the end of the request, each priced from its timestamp.
+            index = pd.date_range(pd.Timestamp(start).ceil('min'), end, freq='1min').union([pd.Timestamp(end)])
+            return pd.DataFrame({'bidPrice': 1.0 + index.minute / 10_000}, index=index)
+        
+        symbols = [("EUR/USD", "EURUSD")]
+        
+        with patch.object(dukascopy_python, 'fetch', side_effect=fake_feed):
+            fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path), min_staleness=timedelta(0))
+            now = pd.Timestamp.now(tz=pytz.UTC)
+            month_dir = tmp_path / "EUR_USD" / f"year={now.year}" / f"month={now.month}"
+            first_shard = min(month_dir.glob("*.parquet"))
+            cached_rows = len(pd.read_parquet(first_shard))
+            
+            fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path), min_staleness=timedelta(0))
+        
+        shards = sorted(month_dir.glob("*.parquet"))
+        assert len(shards) == 2
+        assert shards[0] == first_shard
+        assert len(pd.read_parquet(first_shard)) == cached_rows
+
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_write_csv')
+    def test_get_incomplete_day_redownload(self, mock_write_csv, mock_fetch, fetcher, tmp_path, partial_day_data, sample_tick_data):
+        """Test that local data older than min_staleness triggers a re-download of its tail"""
+        partial_data = partial_day_data.copy()
+        partial_data.index = pd.Timestamp.now(tz=pytz.UTC).floor('s') - pd.to_timedelta(['3h', '2h'])
+        fetcher._save_local_data(str(tmp_path / "EUR_USD"), partial_data)
         mock_fetch.return_value = sample_tick_data
         
         symbols = [("EUR/USD", "EURUSD")]
-        output_dir = "test_output"
         
-        fetcher.get(months_to_fetch=1, symbols=symbols, output_dir=output_dir)
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
         
-        mock_load.assert_called_once()
         mock_fetch.assert_called_once()  # Should fetch to complete the day
-        mock_save.assert_called_once()
+        assert mock_fetch.call_args[0][1] == partial_data.index[-1] - pd.Timedelta(minutes=5)
 
-    @patch('pandas.DataFrame.to_csv')  # Add this
-    @patch('os.makedirs')
-    @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
-    @patch.object(Dukascopy_Tick_Data_Fetcher, '_save_local_data')
-    def test_get_partial_existing_data_extended_range(self, mock_save, mock_fetch, mock_load, mock_makedirs, mock_to_csv, fetcher, sample_tick_data):
-        """Test requesting 6 months when 1 month exists - should only download missing months"""
-        # Setup: 1 month of existing data within the date range
-        current_time = pd.Timestamp.now(tz=pytz.UTC)
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_write_csv')
+    def test_get_partial_existing_data_extended_range(self, mock_write_csv, mock_fetch, fetcher, tmp_path, sample_tick_data):
+        """Test requesting 6 months when older data is cached - should only download from the end of the cache"""
+        # Setup: data from 2 months ago, within the 6-month range
+        current_time = pd.Timestamp.now(tz=pytz.UTC).floor('s')
         existing_data = sample_tick_data.copy()
-        # Set data to be from 2 months ago but within the 6-month range
-        two_months_ago = current_time - relativedelta(months=2)
         existing_data.index = pd.date_range(
-            start=two_months_ago, 
+            start=current_time - relativedelta(months=2), 
             periods=len(existing_data), 
-            freq='1h',  # Fix: Use '1h' instead of '1H' 
+            freq='1h',
             tz='UTC'
         )
+        fetcher._save_local_data(str(tmp_path / "EUR_USD"), existing_data)
         
-        mock_load.return_value = existing_data
-        
-        # Make sure fetched data is also within date range
         new_data = sample_tick_data.copy()
         new_data.index = pd.date_range(
             start=current_time - relativedelta(days=30),  # Recent data
@@ -270,26 +639,24 @@ class TestDukascopyTickDataFetcher:
         mock_fetch.return_value = new_data
         
         symbols = [("EUR/USD", "EURUSD")]
-        output_dir = "test_output"
         
-        fetcher.get(months_to_fetch=6, symbols=symbols, output_dir=output_dir)
+        fetcher.get(months_to_fetch=6, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
         
-        mock_load.assert_called_once()
         mock_fetch.assert_called_once()
-        mock_save.assert_called_once()
+        assert mock_fetch.call_args[0][1] == existing_data.index[-1] - pd.Timedelta(minutes=5)
+        assert len(mock_write_csv.call_args[0][0]) == len(existing_data) + len(new_data)
         
     @patch('os.makedirs')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
-    def test_get_fetch_error_continues_with_next_symbol(self, mock_fetch, mock_load, mock_makedirs, fetcher, capsys):
+    def test_get_fetch_error_continues_with_next_symbol(self, mock_fetch, mock_load, mock_makedirs, fetcher, tmp_path, capsys):
         """Test that fetch error for one symbol doesn't stop processing other symbols"""
         mock_load.return_value = pd.DataFrame()
         mock_fetch.side_effect = Exception("Network error")
         
         symbols = [("EUR/USD", "EURUSD"), ("GBP/USD", "GBPUSD")]
-        output_dir = "test_output"
         
-        fetcher.get(months_to_fetch=1, symbols=symbols, output_dir=output_dir)
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
         
         captured = capsys.readouterr()
         assert "ERROR fetching data" in captured.out
@@ -298,15 +665,32 @@ class TestDukascopyTickDataFetcher:
     @patch('os.makedirs')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
-    def test_get_empty_final_dataset(self, mock_fetch, mock_load, mock_makedirs, fetcher, capsys):
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_save_local_data')
+    def test_get_symbol_error_is_isolated(self, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, tmp_path, sample_tick_data, capsys):
+        """Test that an unexpected error for one symbol doesn't stop the other symbols"""
+        mock_load.side_effect = [OSError("Disk error"), pd.DataFrame()]
+        mock_fetch.return_value = sample_tick_data
+        
+        symbols = [("EUR/USD", "EURUSD"), ("GBP/USD", "GBPUSD")]
+        
+        with patch('dukascopy_tick_data_fetcher.MAX_CONCURRENT_SYMBOLS', 1):
+            fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
+        
+        captured = capsys.readouterr()
+        assert "ERROR processing EUR/USD: Disk error" in captured.out
+        assert mock_load.call_count == 2
+
+    @patch('os.makedirs')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
+    def test_get_empty_final_dataset(self, mock_fetch, mock_load, mock_makedirs, fetcher, tmp_path, capsys):
         """Test handling of empty final dataset"""
         mock_load.return_value = pd.DataFrame()
         mock_fetch.return_value = pd.DataFrame()  # Empty fetch result
         
         symbols = [("EUR/USD", "EURUSD")]
-        output_dir = "test_output"
         
-        fetcher.get(months_to_fetch=1, symbols=symbols, output_dir=output_dir)
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
         
         captured = capsys.readouterr()
         # Fix: Update expected message to match actual code
@@ -316,8 +700,8 @@ class TestDukascopyTickDataFetcher:
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_save_local_data')
-    @patch('pandas.DataFrame.to_csv')
-    def test_get_timezone_conversion(self, mock_to_csv, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, sample_tick_data):
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_write_csv')
+    def test_get_timezone_conversion(self, mock_write_csv, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, tmp_path, sample_tick_data):
         """Test that data is properly converted to broker timezone"""
         mock_load.return_value = pd.DataFrame()
         
@@ -331,20 +715,46 @@ class TestDukascopyTickDataFetcher:
             tz='UTC'
         )
         mock_fetch.return_value = data_in_range
+        mock_load.return_value = data_in_range
         
         symbols = [("EUR/USD", "EURUSD")]
-        output_dir = "test_output"
         broker_timezone = "America/New_York"
         
-        fetcher.get(months_to_fetch=1, symbols=symbols, output_dir=output_dir, broker_timezone=broker_timezone)
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path), broker_timezone=broker_timezone)
+        
+        mock_write_csv.assert_called()
+        assert str(mock_write_csv.call_args[0][0].index.tz) == broker_timezone
+
+    @patch('os.makedirs')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_save_local_data')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_write_csv')
+    def test_get_utc_broker_skips_conversion(self, mock_write_csv, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, tmp_path, sample_tick_data):
+        """Test that a UTC broker timezone writes the ticks without converting them"""
+        data_in_range = sample_tick_data.copy()
+        data_in_range.index = pd.date_range(
+            start=pd.Timestamp.now(tz=pytz.UTC) - relativedelta(days=15),
+            periods=len(data_in_range),
+            freq='1h',
+            tz='UTC'
+        )
+        mock_fetch.return_value = data_in_range
+        mock_load.return_value = data_in_range
+        
+        symbols = [("EUR/USD", "EURUSD")]
+        
+        with patch('pandas.DataFrame.tz_convert') as mock_tz_convert:
+            fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path), broker_timezone="Etc/UTC")
         
-        mock_to_csv.assert_called()
+        mock_tz_convert.assert_not_called()
+        assert str(mock_write_csv.call_args[0][0].index.tz) == "UTC"
 
     @patch('os.makedirs')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_save_local_data')
-    def test_get_deduplication(self, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, sample_tick_data):
+    def test_get_deduplication(self, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, tmp_path, sample_tick_data):
         """Test that duplicate timestamps are properly handled"""
         # Create data with duplicate timestamps
         duplicate_data = pd.concat([sample_tick_data, sample_tick_data])
@@ -353,44 +763,81 @@ class TestDukascopyTickDataFetcher:
         mock_fetch.return_value = duplicate_data
         
         symbols = [("EUR/USD", "EURUSD")]
-        output_dir = "test_output"
         
         # This should not raise an error and should handle duplicates gracefully
-        fetcher.get(months_to_fetch=1, symbols=symbols, output_dir=output_dir)
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
         
         mock_save.assert_called()
 
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_write_csv')
+    def test_get_deduplication_output(self, mock_write_csv, mock_fetch, fetcher, tmp_path, sample_tick_data):
+        """Test that duplicated and unordered ticks are cleaned up before they are written"""
+        data_in_range = sample_tick_data.copy()
+        data_in_range.index = pd.date_range(
+            start=pd.Timestamp.now(tz=pytz.UTC) - relativedelta(days=15),
+            periods=len(data_in_range),
+            freq='1h',
+            tz='UTC'
+        )
+        mock_fetch.return_value = pd.concat([data_in_range.iloc[::-1], data_in_range])
+        
+        symbols = [("EUR/USD", "EURUSD")]
+        
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
+        
+        written = mock_write_csv.call_args[0][0]
+        assert written.index.is_monotonic_increasing
+        assert written.index.is_unique
+        assert len(written) == len(data_in_range)
+
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_write_csv')
+    def test_get_combines_local_and_fetched(self, mock_write_csv, mock_fetch, fetcher, tmp_path):
+        """Test that cached ticks are merged with the re-fetched overlap, the fetched ticks winning"""
+        last_day = pd.Timestamp.now(tz=pytz.UTC).floor('D') - relativedelta(days=1)
+        local_index = pd.DatetimeIndex([last_day - relativedelta(days=1), last_day + relativedelta(hours=10)])
+        fetcher._save_local_data(str(tmp_path / "EUR_USD"), pd.DataFrame({'bidPrice': [1.0, 1.0]}, index=local_index))
+        fetched_index = pd.DatetimeIndex([last_day + relativedelta(hours=10), last_day + relativedelta(hours=12)])
+        mock_fetch.return_value = pd.DataFrame({'bidPrice': [2.0, 2.0]}, index=fetched_index)
+        
+        symbols = [("EUR/USD", "EURUSD")]
+        
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
+        
+        assert mock_fetch.call_args[0][1] == last_day + relativedelta(hours=10) - pd.Timedelta(minutes=5)
+        written = mock_write_csv.call_args[0][0]
+        assert list(written['bidPrice']) == [1.0, 2.0, 2.0]
+
     @patch('os.makedirs')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
     @patch.object(Dukascopy_Tick_Data_Fetcher, '_save_local_data')
-    def test_get_multiple_symbols(self, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, sample_tick_data):
+    def test_get_multiple_symbols(self, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, tmp_path, sample_tick_data):
         """Test processing multiple symbols"""
         mock_load.return_value = pd.DataFrame()
         mock_fetch.return_value = sample_tick_data
         
         symbols = [("EUR/USD", "EURUSD"), ("GBP/USD", "GBPUSD"), ("USD/JPY", "USDJPY")]
-        output_dir = "test_output"
         
-        fetcher.get(months_to_fetch=1, symbols=symbols, output_dir=output_dir)
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
         
         # Should process all symbols
         assert mock_load.call_count == 3
         assert mock_fetch.call_count == 3
         assert mock_save.call_count == 3
 
-    def test_get_date_range_calculation(self, fetcher):
+    def test_get_date_range_calculation(self, fetcher, tmp_path):
         """Test that date ranges are calculated correctly"""
         with patch('pandas.Timestamp.now') as mock_now:
             mock_now.return_value = pd.Timestamp('2025-05-01 12:00:00', tz='UTC')
             
-            with patch.object(fetcher, '_load_local_data', return_value=pd.DataFrame()):
+            with patch.object(fetcher, '_load_local_data') as mock_load:
                 with patch.object(fetcher, '_fetch_from_dukascopy', return_value=pd.DataFrame()):
                     with patch('os.makedirs'):
                         symbols = [("EUR/USD", "EURUSD")]
-                        output_dir = "test_output"
-                        
-                        fetcher.get(months_to_fetch=2, symbols=symbols, output_dir=output_dir)
+                                        
+                        fetcher.get(months_to_fetch=2, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
                         
                         # Verify the date calculation is correct
                         expected_start = pd.Timestamp('2025-03-01 12:00:00', tz='UTC')
@@ -399,10 +846,10 @@ class TestDukascopyTickDataFetcher:
                         # The _load_local_data should be called with correct dates
                         fetcher._load_local_data.assert_called()
 
-    def test_output_filename_format(self, fetcher):
+    def test_output_filename_format(self, fetcher, tmp_path):
         """Test that output filenames are formatted correctly"""
         with patch('os.makedirs'):
-            with patch.object(fetcher, '_load_local_data', return_value=pd.DataFrame()):
+            with patch.object(fetcher, '_load_local_data') as mock_load:
                 with patch.object(fetcher, '_fetch_from_dukascopy') as mock_fetch:
                     # Create data within the expected date range
                     current_time = pd.Timestamp.now(tz=pytz.UTC)
@@ -417,20 +864,88 @@ class TestDukascopyTickDataFetcher:
                         tz='UTC'
                     ))
                     mock_fetch.return_value = sample_data
+                    mock_load.return_value = sample_data
                     
-                    with patch('pandas.DataFrame.to_csv') as mock_to_csv:
+                    with patch.object(fetcher, '_write_csv') as mock_write_csv:
                         with patch.object(fetcher, '_save_local_data'):
                             symbols = [("EUR/USD", "EURUSD")]
-                            output_dir = "test_output"
+                                                
+                            fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path))
                             
-                            fetcher.get(months_to_fetch=1, symbols=symbols, output_dir=output_dir)
-                            
-                            mock_to_csv.assert_called()
-                            call_args = mock_to_csv.call_args[0][0]
+                            mock_write_csv.assert_called()
+                            call_args = mock_write_csv.call_args[0][1]
                             assert "EURUSD" in call_args
                             assert "Europe_Helsinki" in call_args
                             assert call_args.endswith(".csv")
 
+    @patch('os.makedirs')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_load_local_data')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_fetch_from_dukascopy')
+    @patch.object(Dukascopy_Tick_Data_Fetcher, '_save_local_data')
+    def test_get_parquet_output(self, mock_save, mock_fetch, mock_load, mock_makedirs, fetcher, tmp_path, sample_tick_data):
+        """Test that output_format='parquet' writes the processed ticks as parquet"""
+        data_in_range = sample_tick_data.copy()
+        data_in_range.index = pd.date_range(
+            start=pd.Timestamp.now(tz=pytz.UTC) - relativedelta(days=15),
+            periods=len(data_in_range),
+            freq='1h',
+            tz='UTC'
+        )
+        mock_fetch.return_value = data_in_range
+        mock_load.return_value = data_in_range
+        
+        symbols = [("EUR/USD", "EURUSD")]
+        
+        fetcher.get(months_to_fetch=1, symbols=symbols, tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path), output_format='parquet')
+        
+        result = pd.read_parquet(tmp_path / "EURUSD-Europe_Helsinki.parquet")
+        assert len(result) == len(data_in_range)
+        assert str(result.index.tz) == "Europe/Helsinki"
+
+    def test_get_invalid_output_format(self, fetcher, tmp_path):
+        """Test that an unknown output format is rejected"""
+        with pytest.raises(ValueError, match="Unknown output format"):
+            fetcher.get(months_to_fetch=1, symbols=[], tick_data_repo_dir=str(tmp_path), broker_ticks_output_dir=str(tmp_path), output_format='xlsx')
+
+    def test_write_csv_keeps_parser_layout(self, fetcher, tmp_path, sample_tick_data):
+        """Test that the broker CSV keeps the layout the MQL5 parser expects and round-trips every tick"""
+        edge_cases = pd.DataFrame(
+            {'bidPrice': [100.0, 1.5], 'askPrice': [100.25, 2.0], 'bidVolume': [1e-07, 1.0], 'askVolume': [1.8e-06, 0.0]},
+            index=pd.DatetimeIndex(['2025-04-25 06:31:52', '2025-04-25 06:31:53'], tz='UTC')
+        )
+        processed_df = pd.concat([sample_tick_data, edge_cases]).rename_axis('timestamp').tz_convert("Europe/Helsinki")
+        
+        fetcher._write_csv(processed_df, str(tmp_path / "out.csv"))
+        
+        lines = (tmp_path / "out.csv").read_text().splitlines()
+        assert lines[0] == "timestamp,bidPrice,askPrice,bidVolume,askVolume"
+        assert all(re.fullmatch(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{6}\+03:00(,[0-9.e+-]+){4}", line) for line in lines[1:])
+        assert lines[1] == "2025-04-25 09:31:49.984000+03:00,1.90169,1.9021,0.54,0.12"
+        assert lines[-2] == "2025-04-25 09:31:52.000000+03:00,100,100.25,1e-7,0.0000018"  # to_csv wrote 09:31:52+03:00,100.0,...,1e-07,1.8e-06
+        
+        result = pd.read_csv(tmp_path / "out.csv", index_col='timestamp', parse_dates=['timestamp'])
+        pd.testing.assert_frame_equal(result.tz_convert('UTC'), processed_df.tz_convert('UTC'), check_freq=False, check_index_type=False)
+
+    def test_write_csv_in_batches(self, fetcher, tmp_path, sample_tick_data):
+        """Test that writing the broker CSV in slices gives the same file as one slice"""
+        whole_seconds = pd.DataFrame(
+            {'bidPrice': [1.9, 2.0, 2.1], 'askPrice': [2.0, 2.1, 2.2], 'bidVolume': [1.0, 2.0, 3.0], 'askVolume': [4.0, 5.0, 6.0]},
+            index=pd.date_range('2025-04-25 06:32:00', periods=3, freq='1s', tz='UTC')
+        )
+        processed_df = pd.concat([sample_tick_data, whole_seconds]).rename_axis('timestamp').tz_convert("Europe/Helsinki")
+        
+        fetcher._write_csv(processed_df, str(tmp_path / "single.csv"))
+        with patch('dukascopy_tick_data_fetcher.OUTPUT_CSV_BATCH_ROWS', 2):
+            fetcher._write_csv(processed_df, str(tmp_path / "batched.csv"))
+        
+        batched = (tmp_path / "batched.csv").read_text()
+        assert batched == (tmp_path / "single.csv").read_text()
+        assert batched.count("timestamp,") == 1
+        assert "2025-04-25 09:32:00.000000+03:00,1.9,2,1,4" in batched.splitlines()
+        
+        result = pd.read_csv(tmp_path / "batched.csv", index_col='timestamp', parse_dates=['timestamp'])
+        pd.testing.assert_frame_equal(result.tz_convert('UTC'), processed_df.tz_convert('UTC'), check_freq=False, check_index_type=False)
+
 
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file